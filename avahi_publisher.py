@@ -13,6 +13,9 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 from encodings.idna import ToASCII
 
 import dbus
@@ -28,23 +31,84 @@ except ImportError:
 
 # From "/usr/include/avahi-common/defs.h"
 AVAHI_DNS_CLASS_IN = 0x01
+AVAHI_DNS_TYPE_A = 0x01
 AVAHI_DNS_TYPE_CNAME = 0x05
+AVAHI_DNS_TYPE_AAAA = 0x1C
+
+# How long to wait for an answer when checking if a name is already in use, in seconds...
+DEFAULT_RESOLVE_TIMEOUT = 0.5
+
+# How many of these checks may run at the same time (Avahi gets slower with too many)...
+MAX_PARALLEL_CHECKS = 4
+
+# Minimum delay between two checks of the connection to Avahi, in seconds...
+AVAILABILITY_CHECK_INTERVAL = 30
+
+# How long Avahi is given to send the goodbye packets of withdrawn records, in seconds...
+RELEASE_DELAY = 1.0
+
+# Longest TTL accepted for the published records, one day, in seconds...
+MAX_RECORD_TTL = 86400
+
+DBUS_INTERFACE_PEER = "org.freedesktop.DBus.Peer"
+
+# Default limit of avahi-daemon on the records of an entry group ("entries-per-entry-group-max")...
+MAX_ENTRIES_PER_GROUP = 32
+
+# Errors raised by Avahi itself (invalid name, local collision...), as opposed to D-Bus failures...
+AVAHI_ERROR_PREFIX = "org.freedesktop.Avahi."
+
+
+def _validate_ttl(ttl):
+    """Reject a record TTL that Avahi can't be given."""
+
+    if isinstance(ttl, bool) or not isinstance(ttl, int):
+        raise TypeError("record TTL must be an integer: %r" % (ttl,))
+    if not 1 <= ttl <= MAX_RECORD_TTL:
+        raise ValueError("record TTL must be between 1 and %d: %d" % (MAX_RECORD_TTL, ttl))
 
 
 class AvahiPublisher(object):
     """Publish mDNS records to Avahi, using D-BUS."""
 
-    def __init__(self, record_ttl=60):
-        """Initialize the publisher with fixed record TTL value (in seconds)."""
+    def __init__(self, record_ttl=60, resolve_timeout=DEFAULT_RESOLVE_TIMEOUT, addresses=False):
+        """Initialize the publisher with fixed record TTL value (in seconds).
+
+        With "addresses", names are published as A/AAAA records holding the addresses of this
+        host, so that clients resolve them in a single lookup, instead of CNAME records."""
+
+        # Before any D-Bus work, so that a bad value fails fast and leaves nothing to clean up...
+        _validate_ttl(record_ttl)
 
         self.bus = dbus.SystemBus()
 
-        path_server_proxy = self.bus.get_object(avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER)
+        # Avahi's interfaces are well known, so skip the introspection round-trip for each proxy.
+        # Without it arguments aren't converted automatically, and must be given with their D-Bus types...
+        path_server_proxy = self.bus.get_object(avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER, introspect=False)
         self.server = dbus.Interface(path_server_proxy, avahi.DBUS_INTERFACE_SERVER)
+        self._peer = dbus.Interface(path_server_proxy, DBUS_INTERFACE_PEER)
+        self._last_ok = 0.0
 
         self.hostname = self.server.GetHostNameFqdn()
         self.record_ttl = record_ttl
-        self.published = {}
+        self.resolve_timeout = resolve_timeout
+        self.published = {}  # name -> entry group holding its records
+        self._resolve_cache = {}  # name -> (owner or None, address or None, expiration time)
+
+        # All the names point to this host, so the record data never changes...
+        self._addresses = set()
+        self._records = self._host_records() if addresses else []
+        if not self._records:
+            self._records = [(avahi.IF_UNSPEC, AVAHI_DNS_TYPE_CNAME, self._fqdn_to_rdata(self.hostname))]
+
+        # Resetting a committed group withdraws all its names (and Avahi probes them again when
+        # committed), so committed groups are left alone: each batch of new names gets its own
+        # groups, committed by "flush()"...
+        self._staging = []  # (entry group, names) not committed yet
+        self._closed = False
+        # Names refused by Avahi -> time until which they're not worth another try (the cause, like a
+        # local collision, may go away)...
+        self._rejected = {}
 
         logging.debug("Avahi mDNS publisher for: %s", self.hostname)
 
@@ -52,24 +116,55 @@ class AvahiPublisher(object):
     def __del__(self):
         """Remove all published records from mDNS."""
 
+        self.close()
+
+
+    def close(self):
+        """Remove all published records from mDNS, and release the entry groups."""
+
+        # Also covers a constructor that failed half-way...
+        if getattr(self, "_closed", True):
+            return
+        self._closed = True
+        self._closed_at = time.monotonic()
+
+        groups = set(self.published.values())
+        groups.update(group for group, _ in self._staging)
+        self.published.clear()
+        self._staging = []
+
         try:
-            for group in self.published.values():
-                group.Reset()
+            for group in groups:
+                group.Free()
         except dbus.exceptions.DBusException as e:  # ...don't spam on broken connection.
             if e.get_dbus_name() != "org.freedesktop.DBus.Error.ServiceUnknown":
                 raise
 
 
+    def wait_released(self, delay=RELEASE_DELAY):
+        """Give Avahi "delay" seconds since "close()" to announce that the records are gone."""
+
+        # The group is freed at once, but its goodbye packets go out later and D-Bus tells nothing
+        # about them, so only a bounded sleep can cover them...
+        remaining = getattr(self, "_closed_at", 0.0) + delay - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
     def _fqdn_to_rdata(self, fqdn):
         """Convert an FQDN into the mDNS data record format."""
 
-        data = []
-        for part in fqdn.split("."):
-            if part:
-                data.append(chr(len(part)))
-                data.append(part)
+        parts = [part.encode("ascii") for part in fqdn.split(".") if part]
+
+        # Each label is prefixed by its length, and the whole name ends with an empty label...
+        data = bytearray(sum(len(part) for part in parts) + len(parts) + 1)
+        i = 0
+        for part in parts:
+            data[i] = len(part)
+            data[i + 1:i + 1 + len(part)] = part
+            i += 1 + len(part)
 
-        return ("".join(data) + "\0").encode("ascii")
+        return bytes(data)
 
 
     def count(self):
@@ -78,48 +173,230 @@ class AvahiPublisher(object):
         return len(self.published)
 
 
-    def resolve(self, name):
-        """Lookup the current owner for "name", using mDNS."""
+    def is_published(self, name):
+        """Check if a record is currently being published for "name"."""
+
+        return name in self.published
 
+
+    def _host_records(self):
+        """Build the A/AAAA records data for the addresses of this host, interface by interface."""
+
+        # Avahi answers for this host with the address of the interface a query came in from. Do
+        # the same, an address advertised everywhere may only be reachable from one interface
+        # (like "docker0"). The interfaces are only seen from the host network namespace...
+        queries = []
+        for _, name in socket.if_nameindex():
+            try:
+                interface = int(self.server.GetNetworkInterfaceIndexByName(dbus.String(name)))
+            except dbus.exceptions.DBusException:  # ...or unknown to Avahi.
+                continue
+
+            for proto, family, rtype in ((avahi.PROTO_INET, socket.AF_INET, AVAHI_DNS_TYPE_A),
+                                         (avahi.PROTO_INET6, socket.AF_INET6, AVAHI_DNS_TYPE_AAAA)):
+                queries.append((interface, name, proto, family, rtype))
+
+        # Interfaces where Avahi doesn't publish this host only fail after the timeout, overlap them...
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CHECKS) as executor:
+            addresses = list(executor.map(self._own_address, queries))
+
+        records = []
+        for (interface, name, proto, family, rtype), address in zip(queries, addresses):
+            if address is None:
+                continue
+
+            logging.debug("Publishing address %s on %s", address, name)
+            self._addresses.add(address)
+            records.append((interface, rtype, socket.inet_pton(family, address.split("%")[0])))
+
+        if not records:
+            logging.warning("No address found for '%s', publishing CNAME records instead", self.hostname)
+
+        return records
+
+
+    def _own_address(self, query):
+        """Lookup the address of this host on an interface, None if it has none there."""
+
+        interface, _, proto, _, _ = query
         try:
-            # TODO: Find out if it's possible to manipulate (shorten) the timeout...
-            response = self.server.ResolveHostName(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC,
-                                                   name.encode("ascii"), avahi.PROTO_UNSPEC,
-                                                   dbus.UInt32(0))
+            response = self.server.ResolveHostName(dbus.Int32(interface), dbus.Int32(proto),
+                                                   dbus.String(self.hostname), dbus.Int32(proto),
+                                                   dbus.UInt32(0), timeout=self.resolve_timeout)
+        except dbus.exceptions.DBusException:
+            return None
+
+        return str(response[4])
+
+
+    def _lookup(self, name):
+        """Lookup the current owner and address for "name", using mDNS."""
+
+        cached = self._resolve_cache.get(name)
+        if cached and cached[2] > time.monotonic():
+            return cached[:2]
+
+        try:
+            # A name nobody owns only fails after Avahi's own (long) timeout, so don't wait for it
+            # and consider that nobody answering quickly enough means the name is free...
+            response = self.server.ResolveHostName(dbus.Int32(avahi.IF_UNSPEC), dbus.Int32(avahi.PROTO_UNSPEC),
+                                                   dbus.String(name), dbus.Int32(avahi.PROTO_UNSPEC),
+                                                   dbus.UInt32(0), timeout=self.resolve_timeout)
             #return response[2].decode("ascii")
-            return response[2]
+            owner, address = response[2], str(response[4])
         except (NameError, dbus.exceptions.DBusException):
+            owner, address = None, None
+
+        self._resolve_cache[name] = (owner, address, time.monotonic() + self.record_ttl)
+        return owner, address
+
+
+    def resolve(self, name):
+        """Lookup the current owner for "name", using mDNS."""
+
+        return self._lookup(name)[0]
+
+
+    def _check_owner(self, cname):
+        """Check that "cname" isn't owned by another host (None if we already publish it)."""
+
+        # The result is cached for the record TTL, so only new names pay for the lookup...
+        logging.info("Checking for '%s' availability...", cname)
+        current_owner, address = self._lookup(cname)
+
+        if current_owner:
+            # An address record answers with the name itself, recognize ours by their address...
+            if current_owner != self.hostname and address not in self._addresses:
+                logging.error("DNS entry '%s' is already owned by '%s'", cname, current_owner)
+                return False
+
+            # We may have discovered ourselves, but this is not a fatal problem...
+            logging.warning("DNS entry '%s' is already being published by this machine", cname)
             return None
 
+        return True
+
+
+    def _new_group(self):
+        entry_group_proxy = self.bus.get_object(avahi.DBUS_NAME, self.server.EntryGroupNew(), introspect=False)
+        return dbus.Interface(entry_group_proxy, avahi.DBUS_INTERFACE_ENTRY_GROUP)
+
+
+    def _add_cname(self, group, cname):
+        try:
+            for interface, rtype, rdata in self._records:
+                group.AddRecord(dbus.Int32(interface), dbus.Int32(avahi.PROTO_UNSPEC), dbus.UInt32(0),
+                                dbus.String(cname), dbus.UInt16(AVAHI_DNS_CLASS_IN), dbus.UInt16(rtype),
+                                dbus.UInt32(self.record_ttl), dbus.ByteArray(rdata))
+        except dbus.exceptions.DBusException:
+            # Make the next "available()" call check the connection for real...
+            self._last_ok = 0.0
+            raise
+
+
+    def _try_add_cname(self, group, cname):
+        """Add the records of a name to "group", return False if Avahi refused it."""
+
+        try:
+            self._add_cname(group, cname)
+        except dbus.exceptions.DBusException as e:
+            # Anything but Avahi's own errors means the connection is in trouble...
+            if not (e.get_dbus_name() or "").startswith(AVAHI_ERROR_PREFIX):
+                raise
+            logging.error("Avahi rejected '%s': %s", cname, e.get_dbus_message())
+            self._rejected[cname] = time.monotonic() + self.record_ttl
+            return False
+
+        return True
+
 
     def publish_cname(self, cname, force=False):
-        """Publish a CNAME record."""
+        """Add a CNAME record, to be published on the next "flush()"."""
 
         if not force:
-            # Unfortunately, this takes a few seconds in the expected case...
-            logging.info("Checking for '%s' availability...", cname)
-            current_owner = self.resolve(cname)
+            status = self._check_owner(cname)
+            if not status:
+                return status is None
 
-            if current_owner:
-                if current_owner != self.hostname:
-                    logging.error("DNS entry '%s' is already owned by '%s'", cname, current_owner)
-                    return False
+        return self._stage(cname)
 
-                # We may have discovered ourselves, but this is not a fatal problem...
-                logging.warning("DNS entry '%s' is already being published by this machine", cname)
-                return True
 
-        entry_group_proxy = self.bus.get_object(avahi.DBUS_NAME, self.server.EntryGroupNew())
-        group = dbus.Interface(entry_group_proxy, avahi.DBUS_INTERFACE_ENTRY_GROUP)
+    def _stage(self, cname):
+        """Add a name to the pending records, return False if Avahi rejected it."""
 
-        group.AddRecord(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, dbus.UInt32(0), cname.encode("ascii"),
-                        AVAHI_DNS_CLASS_IN, AVAHI_DNS_TYPE_CNAME, self.record_ttl,
-                        self._fqdn_to_rdata(self.hostname))
-        group.Commit()
-        self.published[cname] = group
+        if cname in self.published or any(cname in names for _, names in self._staging):
+            return True
 
+        if self._is_rejected(cname):
+            return False
+
+        # Avahi limits the size of a group, open another one when the current is full...
+        if not self._staging or (len(self._staging[-1][1]) + 1) * len(self._records) > MAX_ENTRIES_PER_GROUP:
+            self._staging.append((self._new_group(), []))
+
+        group, names = self._staging[-1]
+        if not self._try_add_cname(group, cname):
+            # Some of its records may have been added, start the (uncommitted) group over...
+            group.Reset()
+            names[:] = [name for name in names if self._try_add_cname(group, name)]
+            return False
+
+        names.append(cname)
         return True
 
+
+    def _is_rejected(self, cname):
+        expires = self._rejected.get(cname)
+        if expires is None:
+            return False
+        if expires > time.monotonic():
+            return True
+
+        del self._rejected[cname]
+        return False
+
+
+    def publish_cnames(self, cnames, force=False):
+        """Publish several CNAME records, committed together."""
+
+        # Names recently refused by Avahi would fail again, don't even check who owns them...
+        cnames = [cname for cname in cnames if not self._is_rejected(cname)]
+
+        if force:
+            statuses = [True] * len(cnames)
+        else:
+            # Each check waits on the network, so overlap a few of them...
+            with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CHECKS) as executor:
+                statuses = list(executor.map(self._check_owner, cnames))
+
+        done = []
+        for cname, status in zip(cnames, statuses):
+            if status:
+                status = self._stage(cname)
+            if status or status is None:
+                done.append(cname)
+
+        self.flush()
+
+        return done
+
+
+    def flush(self):
+        """Commit the names staged since the last call, leaving the published ones untouched."""
+
+        try:
+            while self._staging:
+                group, names = self._staging[0]
+                if names:
+                    group.Commit()
+                    self.published.update(dict.fromkeys(names, group))
+                else:
+                    group.Free()
+                self._staging.pop(0)
+        except dbus.exceptions.DBusException:
+            self._last_ok = 0.0
+            raise
+
     def encode_dns(self,name):
         out = []
         for part in name.split('.'):
@@ -139,23 +416,55 @@ class AvahiPublisher(object):
     def unpublish(self, name):
         """Remove a published record from mDNS."""
 
-        self.published[name].Reset()
-        del self.published[name]
+        self.unpublish_cnames([name])
+
+    def unpublish_cnames(self, names):
+        """Remove several published records, committed together."""
+
+        # Check them all first, so that an unknown name leaves the published records untouched...
+        unknown = [name for name in names if name not in self.published]
+        if unknown:
+            raise KeyError(unknown[0])
+
+        groups = set()
+        for name in names:
+            groups.add(self.published.pop(name))
+            self._resolve_cache.pop(name, None)
+
+        # A group can only be rebuilt as a whole, so only the ones holding these names are, once...
+        try:
+            for group in groups:
+                group.Reset()
+                remaining = [cname for cname, other in self.published.items() if other is group]
+                for cname in remaining:
+                    if not self._try_add_cname(group, cname):
+                        del self.published[cname]
+
+                if any(self.published.get(cname) is group for cname in remaining):
+                    group.Commit()
+                else:
+                    group.Free()
+        except dbus.exceptions.DBusException:
+            self._last_ok = 0.0
+            raise
 
 
     def available(self):
         """Check if the connection to Avahi is still available."""
 
+        # Records are refreshed by Avahi itself, but a restarted Avahi must be noticed well within their TTL...
+        if time.monotonic() - self._last_ok < min(self.record_ttl / 2, AVAILABILITY_CHECK_INTERVAL):
+            return True
+
         try:
-            # This is just a dummy call to test the connection...
-            self.server.GetVersionString()
+            # This is just a dummy call to test the connection, answered by libdbus itself...
+            self._peer.Ping()
         except dbus.exceptions.DBusException as e:
-            if e.get_dbus_name() != "org.freedesktop.DBus.Error.ServiceUnknown":
-                raise
-
-            logging.error("Lost Connection to Dbus")
+            # Whatever the reason (Avahi gone or hung, bus restarted), the caller reconnects...
+            logging.error("Lost Connection to Dbus: %s", e.get_dbus_name())
             return False
 
+        self._last_ok = time.monotonic()
         return True
 
 
@@ -51,17 +51,21 @@ def daemonize():
     os.umask(0o022)
 
     # Redirect the standard file descriptors to "/dev/null"...
-    f = open(os.devnull, "r")
-    os.dup2(f.fileno(), sys.stdin.fileno())
-    assert sys.stdin.fileno() == 0
+    devnull_r = os.open(os.devnull, os.O_RDONLY)
+    devnull_w = os.open(os.devnull, os.O_WRONLY)
 
-    f = open(os.devnull, "r")
-    os.dup2(f.fileno(), sys.stdout.fileno())
-    assert sys.stdout.fileno() == 1
+    try:
+        os.dup2(devnull_r, sys.stdin.fileno())
+        assert sys.stdin.fileno() == 0
+
+        os.dup2(devnull_w, sys.stdout.fileno())
+        assert sys.stdout.fileno() == 1
 
-    f = open(os.devnull, "r")
-    os.dup2(f.fileno(), sys.stderr.fileno())
-    assert sys.stderr.fileno() == 2
+        os.dup2(devnull_w, sys.stderr.fileno())
+        assert sys.stderr.fileno() == 2
+    finally:
+        os.close(devnull_r)
+        os.close(devnull_w)
 
 
 # vim: set expandtab ts=4 sw=4:
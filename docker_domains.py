@@ -1,105 +1,341 @@
 #!/bin/env python3
 import logging
-import re
+import random
+import sys
+import threading
+import time
 import docker
+import requests
 import string
+from functools import lru_cache
+
+# Prefer an engine that copes better with pathological inputs when one is installed: "re2" works
+# on finite automata, so its matching time is linear in the input, "regex" is a faster backtracker
+try:
+    import re2 as re
+except ImportError:
+    try:
+        import regex as re
+    except ImportError:
+        import re
+
+# Minimum delay between two effective parses, in seconds
+DEFAULT_MIN_PARSE_INTERVAL = 1.0
+
+# Delay between two full listings of the containers, in case some events were missed, in seconds
+DEFAULT_RESYNC_INTERVAL = 60
+
+# "docker-mdns.enable" overrides the default only when set to one of these
+_ENABLE_LABEL_VALUES = {"true": True, "false": False}
+
+# Router rules of Traefik v2 and v3 are "traefik.http.routers.<name>.rule"
+_TRAEFIK_ROUTER_PREFIXES = ("traefik.http.routers.", "traefik.https.routers.")
+# Traefik v1 has a single rule per container, e.g. "Host:a.local,b.local;PathPrefix:/app"
+_TRAEFIK_V1_RULE = "traefik.frontend.rule"
+# No nested quantifier, so that no label value can make the engine backtrack
+_HOST_V2V3_RE = re.compile(r"Host\(([^)]*)\)")
+_BACKTICK_HOST_RE = re.compile(r"`([^`]+)`")
+_DOMAIN_LABEL_CHARS = frozenset(string.ascii_letters + string.digits + "-")
+
+
+@lru_cache(maxsize=4096)
+def _is_valid_domain(domain):
+    """Check that a name can be published as a CNAME"""
+
+    # A plain scan, no regular expression engine is needed (nor can be abused) for this
+    if not domain or len(domain) > 253:
+        return False
+    for label in domain.split("."):
+        if not 0 < len(label) <= 63 or label[0] == "-" or label[-1] == "-":
+            return False
+        if not _DOMAIN_LABEL_CHARS.issuperset(label):
+            return False
+    return True
+
+
+@lru_cache(maxsize=1024)
+def _extract_hosts(rule):
+    """Return the names of the Host() matchers of a router rule"""
+
+    # The same rules come back at every parse, only new ones reach the regular expressions
+    return tuple(domain for match in _HOST_V2V3_RE.finditer(rule) for domain in _BACKTICK_HOST_RE.findall(match.group(1)))
+
+
+def _extract_v1_hosts(rule):
+    """Return the names of the Host: matchers of a Traefik v1 frontend rule"""
+
+    hosts = []
+    for matcher in rule.split(";"):
+        matcher = matcher.strip()
+        if matcher.startswith("Host:"):
+            hosts.extend(name.strip() for name in matcher[5:].split(",") if name.strip())
+    return hosts
+
 
 class DockerDomains(object):
     """Parse Docker labels to select Domain names to publish"""
 
-    def __init__(self, enable):
-        """Initialize the Parser"""
+    def __init__(self, enable, min_parse_interval=DEFAULT_MIN_PARSE_INTERVAL, wake=None):
+        """Initialize the Parser, "wake" is an optional event to set when containers change"""
 
         self.docker = docker.from_env()
 
         self.enable = enable
-        self.domains = {}
+        # Origin ("Dom", "Docker" or "Supp") of each domain
+        self._domain_type = {}
+        # Maintained along with the dict, so that the main loop never has to scan it: the counts
+        # and the live domains not published yet
+        self._live_count = 0
+        self._supp_count = 0
+        self._dirty = set()
+
+        # Domains of the running containers, kept up to date from the Docker event stream
+        self._container_domains = {}
+        self._pending = set()
+        # When disabled by default, only the containers carrying the enable label can give a
+        # domain: let Docker leave out the others. The label is matched on its key alone, since
+        # its value is compared case-insensitively and Docker ANDs several label filters
+        self._list_filters = {} if enable else {"label": "docker-mdns.enable"}
+        self._resync = True
+        self._next_resync = 0.0
+        self._events = None
+        self._watching = False
+        self._lock = threading.Lock()
+        self._changed = wake if wake is not None else threading.Event()
+
+        self.min_parse_interval = min_parse_interval
+        self._next_parse = 0.0
 
     def __len__(self):
-        cnt = 0
-        for value in self.domains.values():
-            if value[0] != "Supp":
-                cnt += 1
-        return cnt
+        return self._live_count
+
+    def _watch_events(self, events):
+        """Queue the ids of the containers which started or stopped"""
+
+        try:
+            for event in events:
+                # "id" is only kept by old API versions, "Actor" is the current field
+                container_id = (event.get("Actor") or {}).get("ID") or event.get("id")
+                if not container_id:
+                    continue
+                with self._lock:
+                    self._pending.add(container_id)
+                self._changed.set()
+        except Exception as e:
+            logging.debug("Docker event stream closed: %s", e)
+
+        # Events may have been lost, the next parse has to list all the containers again
+        with self._lock:
+            if events is self._events:
+                self._watching = False
+                self._resync = True
+                self._changed.set()
+
+    def _start_watcher(self):
+        # Labels never change on a container, the listing filter applies to its events as well
+        filters = dict(self._list_filters, type="container", event=["start", "die", "destroy"])
+        events = self.docker.events(decode=True, filters=filters)
+        with self._lock:
+            self._events = events
+            self._watching = True
+        threading.Thread(target=self._watch_events, args=(events,), daemon=True).start()
+
+    def _refresh(self, container_id):
+        """Update the cached domains of a single container"""
+
+        try:
+            container = self.docker.api.inspect_container(container_id)
+        except docker.errors.NotFound:
+            self._container_domains.pop(container_id, None)
+            return
+
+        # Everything comes from the single inspect reply, no other request is needed
+        running = (container.get("State") or {}).get("Running", False)
+        labels = (container.get("Config") or {}).get("Labels") or {}
+        name = container.get("Name", "?")
+
+        if running:
+            logging.debug("Container %s is running", name)
+            self._container_domains[container_id] = self._domains_of(labels)
+        else:
+            logging.debug("Container %s is stopped", name)
+            self._container_domains.pop(container_id, None)
+
+    def wait(self, timeout):
+        """Wait until some containers started or stopped, or until the timeout expires"""
+
+        if self._changed.wait(timeout):
+            # Changes usually come in bursts, let them settle until the next parse is allowed
+            delay = self._next_parse - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._changed.clear()
 
     def parse(self):
 
-        cnames = {}
-        r = re.compile("^traefik\.https?\.routers\..+\.rule$")
-        hst = re.compile("Host\(\s*(`(?:[^`]+)`(?:\s*,\s*`(?:[^`]+)`)*)\s*\)")
-
-        for container in self.docker.containers.list():
-            labels = container.labels
-
-            if (self.enable == False and "docker-mdns.enable" in labels and labels[
-                "docker-mdns.enable"].lower() == "true") or (self.enable == True and not (
-                    "docker-mdns.enable" in labels and labels["docker-mdns.enable"].lower() == "false")):
-                res = list(filter(r.match, list(labels.keys())))
-                if len(res) > 0:
-                    for val in res:
-                        for match in hst.finditer(labels[val]):
-                            string_lst = [s.strip() for s in re.split(",(?=\s*`)", match.group(1))]
-                            for domain in string_lst:
-                                match1 = re.match("`(.*)`",domain)
-                                if match1:
-                                    cnames[match1.group(1)] = True
-                if "docker-mdns.domain" in labels:
-                    cnames[labels["docker-mdns.domain"]] = True
-
-        for key in cnames.keys():
-            if key not in self.domains:
-                self.add_domain(key, "Docker")
-
-        for key,value in self.domains.items():
-            if key not in cnames and value[0] == "Docker":
-                self.domains[key][0] = "Supp"
+        now = time.monotonic()
+        if now < self._next_parse:
+            return
+        # A little jitter keeps several instances from hitting Docker in lockstep
+        self._next_parse = now + self.min_parse_interval * random.uniform(1.0, 1.1)
+
+        with self._lock:
+            resync = self._resync or now >= self._next_resync
+            watching = self._watching
+            pending = self._pending
+            self._resync = False
+            self._pending = set()
+
+        if not resync and not pending:
+            # Nothing changed since the last parse
+            return
+
+        try:
+            if resync:
+                self._next_resync = now + DEFAULT_RESYNC_INTERVAL
+                # Watch before listing, so that no change is lost in between
+                if not watching:
+                    self._start_watcher()
+                # The low-level API returns the labels of all the containers in a single request
+                containers = self.docker.api.containers(filters=self._list_filters)
+                # The labels of a container never change, only the new ones need to be parsed
+                known = self._container_domains
+                self._container_domains = {
+                    container["Id"]: known[container["Id"]] if container["Id"] in known else self._domains_of(container.get("Labels") or {})
+                    for container in containers
+                }
+            else:
+                for container_id in pending:
+                    self._refresh(container_id)
+        except (docker.errors.APIError, requests.exceptions.ConnectionError) as e:
+            # Keep the known domains, available() will tell whether to reconnect
+            logging.error("Cannot list the containers: %s", e)
+            self._drop_events()
+            return
+
+        cnames = set().union(*self._container_domains.values())
+        known = set(self._domain_type)
+
+        for key in cnames - known:
+            self.add_domain(key, "Docker")
+
+        # A container came back before its suppressed domains were cleaned
+        for key in cnames & known:
+            if self._domain_type[key] == "Supp":
+                self._revive(key)
+
+        for key in known - cnames:
+            if self._domain_type[key] == "Docker":
+                self._suppress(key)
+
+    def _domains_of(self, labels):
+        """Return the domains defined by the labels of a container"""
+
+        if not _ENABLE_LABEL_VALUES.get(labels.get("docker-mdns.enable", "").lower(), self.enable):
+            return frozenset()
+
+        cnames = set()
+
+        if "Host:" in labels.get(_TRAEFIK_V1_RULE, ""):
+            for domain in _extract_v1_hosts(labels[_TRAEFIK_V1_RULE]):
+                self._add_cname(cnames, domain)
+        for key, value in labels.items():
+            # Plain string tests, most labels are not router rules
+            if not key.endswith(".rule") or not key.startswith(_TRAEFIK_ROUTER_PREFIXES):
+                continue
+            # Without a quoted name, a rule cannot give any domain
+            if "Host(" not in value or "`" not in value:
+                continue
+            for domain in _extract_hosts(value):
+                self._add_cname(cnames, domain)
+        if "docker-mdns.domain" in labels:
+            self._add_cname(cnames, labels["docker-mdns.domain"])
+        return frozenset(cnames)
+
+    def _add_cname(self, cnames, domain):
+        if _is_valid_domain(domain):
+            # The same names come from many containers and parses, share a single copy of each
+            cnames.add(sys.intern(domain))
+        else:
+            logging.debug("Ignoring invalid domain name '%s'", domain)
+
+    def _suppress(self, domain):
+        self._domain_type[domain] = "Supp"
+        self._live_count -= 1
+        self._supp_count += 1
+        self._dirty.discard(domain)
+
+    def _revive(self, domain):
+        self._domain_type[domain] = "Docker"
+        self._live_count += 1
+        self._supp_count -= 1
+        self._dirty.add(domain)
 
     def add_domain(self, domain, type):
-        if domain not in self.domains:
-            self.domains[domain] = [type, False]
+        if domain not in self._domain_type:
+            self._domain_type[domain] = type
+            self._live_count += 1
+            self._dirty.add(domain)
 
     def add_domains(self, list):
-        for domain in list:
-            self.add_domain(domain, "Dom")
+        new = [domain for domain in dict.fromkeys(list) if domain not in self._domain_type]
+        self._domain_type.update(dict.fromkeys(new, "Dom"))
+        self._live_count += len(new)
+        self._dirty.update(new)
 
     def suppressed(self ):
-        for key,value in self.domains.items():
-            if value[0] == "Supp":
-                return True
-        return False
+        return self._supp_count > 0
 
     def clean(self):
-        domains= {}
-        for key,value in self.domains.items():
-            if value[0] != "Supp":
-                domains[key] = value
-        self.domains = domains
-
-    def update_list(self):
-        list = []
-        for key,value in self.domains.items():
-            if not value[1] and value[0] != "Supp":
-                list.append(key)
-        return list
-
-    def updated(self):
-        self.parse()
-        return not all(value[1] for value in self.domains.values())
+        for key in [key for key, type in self._domain_type.items() if type == "Supp"]:
+            del self._domain_type[key]
+        self._supp_count = 0
+
+    def pending_updates(self):
+        """Return the domains still to be published, an empty list if there is none"""
+
+        return list(self._dirty)
 
     def all_new(self):
-        for keys in self.domains.keys():
-            if self.domains[keys][0] != "Supp":
-                self.domains[keys][1] = False
+        for keys, type in self._domain_type.items():
+            if type != "Supp":
+                self._dirty.add(keys)
 
     def update(self, domain):
-        if domain in self.domains:
-            self.domains[domain][1] = True
+        self._dirty.discard(domain)
+
+    def reconnect(self):
+        """Replace the connection to Docker, keeping the known domains"""
+
+        try:
+            self.docker = docker.from_env()
+        except docker.errors.DockerException as e:
+            logging.error("Cannot connect to Docker: %s", e)
+            return
+
+        # The event stream of the old connection is useless, start over from a full listing
+        self._drop_events()
+
+    def _drop_events(self):
+        with self._lock:
+            # Ends the watcher thread, otherwise the next resync would start a second one
+            if self._events is not None:
+                try:
+                    self._events.close()
+                except OSError as e:
+                    logging.debug("Cannot close the Docker event stream: %s", e)
+            self._events = None
+            self._watching = False
+            self._resync = True
 
     def available(self):
         """Check if the connection to Docker is still available."""
 
+        # The event stream ends with the connection, no need to probe while it is running
+        if self._watching:
+            return True
         try:
             return self.docker.ping()
-        except docker.errors.APIError as e:
+        except (docker.errors.APIError, requests.exceptions.ConnectionError) as e:
             logging.error("Lost Connection to Docker")
             return False
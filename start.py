@@ -18,29 +18,100 @@ import logging
 import logging.handlers
 import re
 import signal
-import functools
+import queue
+import threading
 
 from time import sleep
 
+import dbus
+
 from daemonize import daemonize
-from avahi_publisher import AvahiPublisher
-from argparse import ArgumentParser
+from avahi_publisher import AvahiPublisher, MAX_RECORD_TTL
+from argparse import ArgumentParser, ArgumentTypeError
 from docker_domains import DockerDomains
 
 
 # Default Time-to-Live for mDNS records, in seconds...
 DEFAULT_DNS_TTL = 60
 DEFAULT_PAUSE_TIME = 5
+# Longest pause between attempts to reach Docker or Avahi when they are down, in seconds...
+MAX_RETRY_DELAY = 60
+
+# Names given on the command line must be in the ".local" domain...
+_CNAME_RE = re.compile(r"[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*\.local")
+
+# Writes the log records queued by the other threads...
+log_listener = None
+
+
+def setup_logging(log, verbose):
+    """Send all log records through a queue, to be written by a background thread."""
+
+    # Since an eventual log file must support external log rotation, we must do this the hard way...
+    format = logging.Formatter("%(asctime)s: %(levelname)s [%(process)d]: %(message)s")
+    handler = logging.handlers.WatchedFileHandler(log) if log else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(format)
+
+    # The main loop never waits on the disk (nor on the "os.stat()" done for every record)...
+    log_queue = queue.Queue()
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO,
+                        handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+
+    return logging.handlers.QueueListener(log_queue, handler)
+
+
+def bounded_int(low, high):
+    """Build an argument type accepting integers between "low" and "high" (inclusive)."""
+
+    def parse(value):
+        try:
+            number = int(value)
+        except ValueError:
+            raise ArgumentTypeError("invalid integer: %s" % value)
+
+        if not low <= number <= high:
+            raise ArgumentTypeError("must be between %d and %d: %s" % (low, high, value))
+
+        return number
+
+    return parse
+
+
+def retry_delay(refresh_rate, failures):
+    """Exponential backoff between attempts to reach an unavailable service."""
 
-def handle_signals(publisher, signum, frame):
+    return min(refresh_rate * 2 ** failures, MAX_RETRY_DELAY)
+
+
+class Shutdown(BaseException):
+    """Raised by the signal handlers to leave the main loop, wherever it is."""
+
+
+def handle_signals(signum, frame):
+    """Leave the main loop, which then cleans up and exits."""
+
+    # The interrupted code may hold a lock (e.g. the log queue's), so nothing here may take one.
+    # Raising instead lets it release them while unwinding...
+    raise Shutdown(signum)
+
+
+def shutdown(publisher, signum):
     """Unpublish all mDNS records and exit cleanly."""
 
-    signame = next(v for v, k in signal.__dict__.items() if k == signum)
-    logging.debug("Cleaning up on %s...", signame)
-    publisher.__del__()
+    # A second signal must not interrupt the cleanup...
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+        signal.signal(sig, signal.SIG_IGN)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Cleaning up on %s...", signal.Signals(signum).name)
+    if publisher is not None:
+        publisher.close()
 
-    # Avahi needs time to forget us...
-    sleep(1)
+        # Avahi needs time to forget us...
+        publisher.wait_released()
+
+    # Write out the pending log records...
+    log_listener.stop()
 
     os._exit(0)
 
@@ -51,44 +122,42 @@ def main():
     parser.add_argument('-D', '--daemon', help='Lauch as a daemon.',action='store_true')
     parser.add_argument('-d', '--disable', help='All detected CNAMES are not published if not indicated.',action='store_true')
     parser.add_argument('-r', '--reset', help='Reset publishing if a CNAME is removed', action='store_true')
-    parser.add_argument('-t', '--ttl', help='Set the TTL for all published CNAME records.', default=DEFAULT_DNS_TTL, metavar='<ttl>')
+    parser.add_argument('-t', '--ttl', help='Set the TTL for all published CNAME records.', default=DEFAULT_DNS_TTL, type=bounded_int(1, MAX_RECORD_TTL), metavar='<ttl>')
     parser.add_argument('-v', '--verbose', help='Produce extra output for debugging purposes.', action='store_true')
+    parser.add_argument('-a', '--address', help='Publish A/AAAA records with the addresses of this host instead of CNAME records. Names are resolved in a single lookup, but are not updated if the host addresses change.', action='store_true')
     parser.add_argument('-f', '--force', help='Publish all CNAMEs without checking if they are already being published elsewhere on the network. This is much faster, but generally unsafe.', action='store_true')
-    parser.add_argument('-w', '--wait', help='waiting time between each analysis loop', default=DEFAULT_PAUSE_TIME, metavar='<seconds>')
+    parser.add_argument('-w', '--wait', help='waiting time between each analysis loop', default=DEFAULT_PAUSE_TIME, type=bounded_int(1, 3600), metavar='<seconds>')
     parser.add_argument("cnames", help="List of cnames <hostname.local> to publish in addition to docker", nargs='*')
 
     res = parser.parse_args(sys.argv[1:])
-    ttl = int(res.ttl)
+    ttl = res.ttl
     force = res.force
+    address = res.address
     verbose = res.verbose
     log = res.log
     daemon = res.daemon
     enable = not res.disable
     reset = res.reset
-    refresh_rate = int(res.wait)
-    cnames_cmd = [ cname.lower() for cname in res.cnames ]
+    refresh_rate = res.wait
+    cnames_cmd = list(dict.fromkeys(cname.lower() for cname in res.cnames))
 
-    cname_re = re.compile(r"^[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*\.local$")
+    bad = next((cname for cname in cnames_cmd if not _CNAME_RE.fullmatch(cname)), None)
+    if bad is not None:
+        print("error: malformed hostname: %s" % bad, file=sys.stderr)
+        parser.print_usage()
+        sys.exit(1)
 
-    for cname in cnames_cmd:
-        if not cname_re.match(cname):
-            print("error: malformed hostname: %s" % cname, file=sys.stderr)
-            parser.print_usage()
-            sys.exit(1)
-
-    # Since an eventual log file must support external log rotation, we must do this the hard way...
-    format = logging.Formatter("%(asctime)s: %(levelname)s [%(process)d]: %(message)s")
-    handler = logging.handlers.WatchedFileHandler(log) if log else logging.StreamHandler(sys.stderr)
-    handler.setFormatter(format)
-    logger = logging.getLogger()
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    global log_listener
+    log_listener = setup_logging(log, verbose)
 
     # This must be done after initializing the logger, so that an eventual log file gets created in
     # the right place (the user will assume that relative paths start from the current directory)...
     if daemon:
         daemonize()
 
+    # ...but threads don't survive the fork, so the listener can only be started now.
+    log_listener.start()
+
     logging.info("Avahi/mDNS publisher starting...")
 
     if force:
@@ -97,48 +166,80 @@ def main():
     # The publisher needs to be initialized in the loop, to handle disconnects...
     publisher = None
 
-    docker_domains = DockerDomains(enable)
+    wake = threading.Event()
+
+    docker_domains = DockerDomains(enable, wake=wake)
     docker_domains.add_domains(cnames_cmd)
 
-    while True:
-        if not docker_domains.available():
-            docker_domains = DockerDomains(enable)
-            docker_domains.add_domains(cnames_cmd)
-
-        docker_domains.parse()
-
-        if docker_domains.suppressed() and reset and publisher is not None:
-            publisher.__del__()
-            sleep(1)
-            publisher = None
-            docker_domains.clean()
-            logging.info("Republishing all CNAMEs")
-
-        if not publisher or not publisher.available():
-            publisher = AvahiPublisher(ttl)
-            # To make sure records disappear immediately on exit, clean up properly...
-            signal.signal(signal.SIGTERM, functools.partial(handle_signals, publisher))
-            signal.signal(signal.SIGINT, functools.partial(handle_signals, publisher))
-            signal.signal(signal.SIGQUIT, functools.partial(handle_signals, publisher))
-            docker_domains.all_new()
-
-        if docker_domains.updated():
-            list = docker_domains.update_list()
-            for cname in list:
-                status = publisher.publish_cname(cname, force)
-                if not status:
-                    logging.error("Failed to publish '%s'", cname)
+    # Consecutive loops where Docker or Avahi could not be reached...
+    failures = 0
+
+    try:
+        # To make sure records disappear immediately on exit, clean up properly. The handlers are
+        # installed inside the block which catches what they raise...
+        signal.signal(signal.SIGTERM, handle_signals)
+        signal.signal(signal.SIGINT, handle_signals)
+        signal.signal(signal.SIGQUIT, handle_signals)
+
+        while True:
+            if not docker_domains.available():
+                failures += 1
+                sleep(retry_delay(refresh_rate, failures))
+                docker_domains.reconnect()
+                continue
+
+            docker_domains.parse()
+
+            if docker_domains.suppressed() and reset and publisher is not None:
+                publisher.close()
+                publisher.wait_released()
+                publisher = None
+                docker_domains.clean()
+                logging.info("Republishing all CNAMEs")
+
+            if not publisher or not publisher.available():
+                try:
+                    publisher = AvahiPublisher(ttl, addresses=address)
+                except dbus.exceptions.DBusException as e:
+                    logging.error("Cannot connect to Avahi: %s", e.get_dbus_message())
+                    publisher = None
+                    failures += 1
+                    sleep(retry_delay(refresh_rate, failures))
                     continue
-                else:
-                    docker_domains.update(cname)
 
-            if publisher.count() == len(docker_domains):
-                logging.info("All CNAMEs published")
-            else:
-                logging.warning("%d out of %d CNAMEs published", publisher.count(), len(docker_domains))
-
-        # CNAMEs will exist until we renew it within the TTL duration
-        sleep(refresh_rate)
+                docker_domains.all_new()
+
+            failures = 0
+
+            update_list = docker_domains.pending_updates()
+            if update_list:
+                try:
+                    published = set(publisher.publish_cnames(update_list, force))
+                except dbus.exceptions.DBusException as e:
+                    # The connection is checked again on the next loop...
+                    logging.error("Cannot publish CNAMEs: %s", e.get_dbus_message())
+                    published = set()
+                for cname in update_list:
+                    if cname not in published:
+                        logging.error("Failed to publish '%s'", cname)
+                        continue
+                    else:
+                        docker_domains.update(cname)
+
+                count = publisher.count()
+                total = len(docker_domains)
+                if count == total:
+                    logging.info("All CNAMEs published")
+                else:
+                    logging.warning("%d out of %d CNAMEs published", count, total)
+
+            # Wake up as soon as containers start or stop, and otherwise check everything periodically
+            docker_domains.wait(refresh_rate)
+    except Shutdown as e:
+        shutdown(publisher, e.args[0])
+    finally:
+        # The listener thread is a daemon, write out the records explaining an eventual crash...
+        log_listener.stop()
 
 
 if __name__ == "__main__":